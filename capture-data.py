@@ -20,12 +20,18 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import argparse
+import collections
+import json
 import os
 import struct
 import subprocess
-import sys
+import tempfile
 import time
 
+from srd_runner import decode_sectors
+from vcd import PS_PER_S, falling_edges, read_vcd
+
 # Set to false to debug without Teensy attached
 if True:
     from serial import Serial
@@ -61,6 +67,21 @@ TRACK0      = BIT(4)
 WRITE_PROT  = BIT(5)
 CHANGE_RDY  = BIT(6)
 
+INDEX_CHANNEL = '1'
+FLUX_CHANNEL = '2'
+
+# MFM bit cell length, for 500kbps (HD) media
+CELL_PS = PS_PER_S // 1000000
+
+# How long to wait before reading, after each of the events that disturb the
+# drive. The drive's datasheet values, plus a generous margin before reading.
+DEFAULT_TIMINGS = {
+    'motor_on_ms': 1000,
+    'step_settle_ms': 18,
+    'head_settle_ms': 1,
+    'read_settle_ms': 150,
+}
+
 def monotonic_ms(do_round_up):
     t = time.monotonic()
     if do_round_up:
@@ -68,7 +89,9 @@ def monotonic_ms(do_round_up):
     return int(t * 1000)
 
 class Floppy(object):
-    def __init__(self):
+    # track: The track the head is known to be at, e.g. from the profile saved
+    # by a previous run. If None, the drive is recalibrated to track 0.
+    def __init__(self, track=None):
         # So that __del__ can always read self.s;  an exception thrown opening
         # the serial port will skip assigning the variable.
         self.s = None
@@ -85,9 +108,14 @@ class Floppy(object):
         self._last_step = 0
         self._last_head = 0
 
-        self.select()
-        self.track0()
-        self.deselect()
+        self.set_timings(DEFAULT_TIMINGS)
+
+        if track is None:
+            self.select()
+            self.track0()
+            self.deselect()
+        else:
+            self.set_track(track)
 
     def _set(self, val):
         self._out(self._out_val | val)
@@ -131,7 +159,7 @@ class Floppy(object):
         self._clr(DRIVE_SEL_B)
         self._last_select = monotonic_ms(do_round_up=True)
         self._clr(MOTOR_EN_B)
-        self._last_motor = monotonic_ms(do_round_up=True)
+        self._last_motor_on = monotonic_ms(do_round_up=True)
         self._selected = True
 
     def deselect(self):
@@ -193,6 +221,20 @@ class Floppy(object):
             self._step(True)
         self._track = 0
 
+    def set_timings(self, timings):
+        self.timings = dict(timings)
+
+    def get_track(self):
+        return self._track
+
+    def set_track(self, track):
+        # Correct the track counter, e.g. after reading the actual track
+        # number from the disk, without moving the head.
+        track = int(track)
+        if track < 0 or track > 79:
+            raise Exception('Bad track')
+        self._track = track
+
     def seek(self, track):
         if not self._selected:
             raise Exception('Not selected')
@@ -221,18 +263,18 @@ class Floppy(object):
         self._wait_since(self._last_step, 18)
 
     def settle_before_read(self):
-        self._wait_since(self._last_motor_on, 1000)
+        self._wait_since(self._last_motor_on, self.timings['motor_on_ms'])
         self._wait_since(self._last_select, 1)
-        self.settle_seek_complete()
-        self._wait_since(self._last_head, 1)
-        time.sleep(0.18 - 0.03)
+        self._wait_since(self._last_step, self.timings['step_settle_ms'])
+        self._wait_since(self._last_head, self.timings['head_settle_ms'])
+        time.sleep(self.timings['read_settle_ms'] / 1000.0)
 
     def __del__(self):
         if self.s:
             self._out(0xff)
             self.s.close()
 
-def capture(filename):
+def capture(filename, time_ms=425):
     print('Capturing...')
     cmd = [
         'sigrok-cli',
@@ -241,25 +283,281 @@ def capture(filename):
         '-o', filename,
         '--config', 'samplerate=25m',
         '--channels', '1-2',
-        '--time', '425ms'
+        '--time', '%dms' % time_ms
     ]
     print('+', ' '.join(cmd))
     subprocess.run(cmd, check=True)
 
-if len(sys.argv) > 1:
-    dirname = sys.argv[1]
-else:
-    dirname = 'data'
+def decode_position(filename, time_ms=40):
+    # Returns the (cylinder, head) recorded in the intact ID fields of the
+    # sectors in the start of the capture, or None if none could be decoded.
+    # Decoding just the start is much quicker than decoding the whole capture;
+    # on a standard HD track, 40ms usually holds at least two whole sectors.
+    print('Decoding', filename)
+    signal = read_vcd(filename, time_ms * 10 ** 9)
+    positions = collections.Counter()
+    for sector in decode_sectors(signal, FLUX_CHANNEL):
+        # A sector's data may be damaged while its ID is intact; its position
+        # is still good.
+        if sector.id_crc_ok:
+            positions[(sector.cylinder, sector.head)] += 1
+    if not positions:
+        return None
+    return positions.most_common(1)[0][0]
+
+def index_stable_ps(signal):
+    # Start of the first index pulse that begins two consecutive revolutions of
+    # equal (to within 0.5%) length, i.e. the motor is up to speed.
+    edges = falling_edges(signal.channels[INDEX_CHANNEL][1])
+    for i in range(len(edges) - 2):
+        p0 = edges[i + 1] - edges[i]
+        p1 = edges[i + 2] - edges[i + 1]
+        if abs(p1 - p0) * 200 < p0:
+            return edges[i]
+    return None
+
+def flux_stable_ps(signal, window_ps=10 ** 9):
+    # Start of the first 1ms window after which every window holds valid MFM
+    # (flux transitions 2, 3 or 4 bit cells apart, allowing the odd bad one)
+    # and in which an A1 sync mark has been seen, i.e. the head has settled
+    # over the track.
+    edges = falling_edges(signal.channels[FLUX_CHANNEL][1])
+    num_windows = signal.duration_ps // window_ps
+    good = [0] * (num_windows + 1)
+    bad = [0] * (num_windows + 1)
+    cells = []
+    for a, b in zip(edges, edges[1:]):
+        period = (b - a) / CELL_PS
+        n = int(round(period))
+        if 2 <= n <= 4 and abs(period - n) < 0.25:
+            good[b // window_ps] += 1
+        else:
+            bad[b // window_ps] += 1
+            n = 0
+        cells.append((b, n))
+    stable_ps = 0
+    for w in range(num_windows):
+        if (good[w] == 0) or (bad[w] * 50 > good[w]):
+            stable_ps = (w + 1) * window_ps
+    # 0x4489 has transitions 4, 3, 4, 3 cells apart
+    for i in range(len(cells) - 3):
+        if cells[i][0] < stable_ps:
+            continue
+        if [c[1] for c in cells[i:i + 4]] == [4, 3, 4, 3]:
+            return stable_ps
+    return None
+
+def probe_settle_ms(since, probe_fn, time_ms, find_stable):
+    # Returns how long after since the signal became stable, or None if it
+    # never did. The probe capture is assumed to have ended when sigrok-cli
+    # exits, and its start is derived from that, so the time sigrok-cli takes
+    # to start and shut down is included; see measure_launch_ms().
+    capture(probe_fn, time_ms)
+    end = monotonic_ms(do_round_up=True)
+    signal = read_vcd(probe_fn)
+    stable_ps = find_stable(signal)
+    if stable_ps is None:
+        return None
+    return end - since - (signal.duration_ps - stable_ps) // 10 ** 9
+
+def measure_launch_ms(probe_fn, probes=3):
+    # The part of probe_settle_ms() due to sigrok-cli itself, measured with the
+    # head already settled so that the flux is stable from the very start of
+    # the capture. A capture always pays this delay after settle_before_read()
+    # anyway, so only settle time beyond it needs waiting for. The smallest
+    # result is used, since overestimating it would make waits too short.
+    launch_ms = None
+    for _ in range(probes):
+        since = monotonic_ms(do_round_up=False)
+        ms = probe_settle_ms(since, probe_fn, 100, flux_stable_ps)
+        if ms is None:
+            continue
+        if launch_ms is None or ms < launch_ms:
+            launch_ms = ms
+    return launch_ms
+
+def learn_timings(f):
+    # Measure how long this drive really takes to deliver stable flux after
+    # the motor is turned on, after a step, and after a head switch. Requires
+    # the disk to have readable data on tracks 0 and 1.
+    timings = dict(DEFAULT_TIMINGS)
+    timings['read_settle_ms'] = 0
+    limits = {
+        'motor_on_ms': DEFAULT_TIMINGS['motor_on_ms'],
+        'step_settle_ms':
+            DEFAULT_TIMINGS['step_settle_ms'] + DEFAULT_TIMINGS['read_settle_ms'],
+        'head_settle_ms':
+            DEFAULT_TIMINGS['head_settle_ms'] + DEFAULT_TIMINGS['read_settle_ms'],
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        probe_fn = os.path.join(tmp_dir, 'probe.vcd')
+        measured = {}
+
+        f.deselect()
+        # Let the spindle stop
+        time.sleep(3)
+        f.select()
+        since = monotonic_ms(do_round_up=False)
+        measured['motor_on_ms'] = probe_settle_ms(
+            since, probe_fn, 1000, index_stable_ps)
+
+        f.set_timings(DEFAULT_TIMINGS)
+        f.seek(1)
+        f.set_head(0)
+        f.settle_before_read()
+        f.seek(0)
+        since = monotonic_ms(do_round_up=False)
+        measured['step_settle_ms'] = probe_settle_ms(
+            since, probe_fn, 100, flux_stable_ps)
+
+        f.settle_before_read()
+        f.set_head(1)
+        since = monotonic_ms(do_round_up=False)
+        measured['head_settle_ms'] = probe_settle_ms(
+            since, probe_fn, 100, flux_stable_ps)
+
+        f.settle_before_read()
+        launch_ms = measure_launch_ms(probe_fn)
+        print('Measured sigrok-cli launch delay', launch_ms)
+
+    for key, ms in measured.items():
+        print('Measured', key, ms)
+        if ms is None:
+            timings[key] = limits[key]
+        else:
+            if launch_ms is not None:
+                ms = max(0, ms - launch_ms)
+            timings[key] = min(limits[key], int(ms * 1.25) + 1)
+    print('Learned timings:', timings)
+    return timings
+
+def recapture(f, track, head, timings, fn):
+    # Step away and back first, so that the head really has to settle again
+    # and the timings are put to the test.
+    f.set_timings(timings)
+    f.seek(track + 1 if track < 79 else track - 1)
+    f.seek(track)
+    f.set_head(head)
+    f.settle_before_read()
+    capture(fn)
+    return decode_position(fn)
+
+# Each drive should have its own profile, since it holds the drive's head
+# position and learned settle times.
+DEFAULT_PROFILE_FN = os.path.expanduser('~/.floppy-profile.json')
+
+def load_profile(profile_fn):
+    if not os.path.exists(profile_fn):
+        return {}
+    with open(profile_fn, 'r') as f:
+        return json.load(f)
+
+def save_profile(profile_fn, profile):
+    with open(profile_fn, 'w') as f:
+        json.dump(profile, f, indent=4, sort_keys=True)
+
+parser = argparse.ArgumentParser(
+    description='Capture every track of a floppy disk to .vcd files.')
+parser.add_argument('dirname', nargs='?', default='data',
+    help='Directory to write captures to')
+parser.add_argument('--profile', default=DEFAULT_PROFILE_FN,
+    help='Profile holding the head position and learned settle times of the '
+    'attached drive; use a separate profile for each drive')
+parser.add_argument('--adaptive', action='store_true',
+    help='Use settle times learned for this drive instead of the defaults, '
+    'learning them first if the profile has none')
+parser.add_argument('--relearn', action='store_true',
+    help='With --adaptive, learn settle times even if the profile has them')
+args = parser.parse_args()
+
+dirname = args.dirname
 if not os.path.exists(dirname):
     os.makedirs(dirname)
 
-f = Floppy()
+# The head position is only trusted if the previous run exited cleanly, and
+# only until the first capture: if that can't be decoded to verify it, the
+# drive is recalibrated after all, since e.g. a power cycle or drive swap may
+# have moved the head.
+profile = load_profile(args.profile)
+known_track = profile.pop('track', None)
+save_profile(args.profile, profile)
+
+f = Floppy(known_track)
 f.select()
+if args.adaptive:
+    if args.relearn or 'timings' not in profile:
+        profile['timings'] = learn_timings(f)
+        save_profile(args.profile, profile)
+    f.set_timings(profile['timings'])
+# Once a track fails to decode even with the default timings, the disk has
+# unformatted tracks, and retrying every such track would capture each twice.
+retry_with_defaults = True
+position_known = known_track is None
 for track in range(80):
-    f.seek(track)
     for head in range(2):
-        f.set_head(head)
-        f.settle_before_read()
-        capture(os.path.join(dirname, 'track-t%02d-h%d.vcd' % (track, head)))
+        fn = os.path.join(dirname, 'track-t%02d-h%d.vcd' % (track, head))
+        # A mismatched cylinder is first fixed by correcting the track counter
+        # from the cylinder read from the disk, then by recalibrating once.
+        # Non-standard tracks may never match; their capture is kept anyway.
+        corrected = False
+        recalibrated = False
+        while True:
+            f.seek(track)
+            f.set_head(head)
+            f.settle_before_read()
+            capture(fn)
+            position = decode_position(fn)
+            if (position is None and retry_with_defaults and
+                    f.timings != DEFAULT_TIMINGS):
+                # A heuristic: a failure that repeats with the learned timings
+                # but not with the defaults suggests the learned timings are
+                # too short. A one-off failure, e.g. a weak spot, doesn't.
+                learned_timings = f.timings
+                print('No sectors decoded; retrying with learned timings')
+                position = recapture(f, track, head, learned_timings, fn)
+            if (position is None and retry_with_defaults and
+                    f.timings != DEFAULT_TIMINGS):
+                print('No sectors decoded; retrying with default timings')
+                position = recapture(f, track, head, DEFAULT_TIMINGS, fn)
+                if position is None:
+                    print('Track appears unformatted; not retrying any more '
+                        'tracks with default timings')
+                    f.set_timings(learned_timings)
+                    retry_with_defaults = False
+                else:
+                    print('Learned timings too short; discarding them')
+                    profile.pop('timings', None)
+                    save_profile(args.profile, profile)
+            if position is None:
+                if not position_known:
+                    print('No sectors decoded; recalibrating since the '
+                        'position from the profile is unverified')
+                    f.track0()
+                    position_known = True
+                    recalibrated = True
+                    continue
+                print('No sectors decoded; cannot verify position')
+                break
+            position_known = True
+            id_track, id_side = position
+            if id_side != head:
+                print('Warning: head', head, 'reads sectors with side ID', id_side)
+            if id_track == track:
+                break
+            if recalibrated:
+                print('Warning: track', track, 'reads as cylinder', id_track,
+                    'even after recalibrating; keeping capture')
+                break
+            print('Cylinder mismatch: expected', track, 'found', id_track)
+            if not corrected and 0 <= id_track <= 79:
+                f.set_track(id_track)
+                corrected = True
+            else:
+                f.track0()
+                recalibrated = True
+# Only save the head position if the last capture confirmed it.
+if position is not None and position[0] == f.get_track():
+    profile['track'] = f.get_track()
 f.deselect()
 del f
+save_profile(args.profile, profile)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Stephen Warren <swarren@wwwdotorg.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import argparse
+import os
+
+from image_index import read_index
+from vcd import crop, read_vcd, write_vcd
+
+def describe(sector):
+    if sector is None:
+        return 'absent'
+    if sector.capture == '-':
+        return '%s %s' % (sector.status, sector.hash)
+    return '%s %s (%s rev %d)' % (
+        sector.status, sector.hash, sector.capture, sector.revolution)
+
+def diff_indexes(a, b):
+    # Only tracks whose hashes differ need their sectors compared.
+    diffs = []
+    for ch in sorted(set(a.tracks) | set(b.tracks)):
+        if a.tracks.get(ch) == b.tracks.get(ch):
+            continue
+        secs = {chs for chs in a.sectors if chs[:2] == ch}
+        secs |= {chs for chs in b.sectors if chs[:2] == ch}
+        for chs in sorted(secs):
+            sa = a.sectors.get(chs)
+            sb = b.sectors.get(chs)
+            if sa and sb and (sa.hash, sa.status) == (sb.hash, sb.status):
+                continue
+            diffs.append((chs, sa, sb))
+    return diffs
+
+def extract_flux(index, label, diffs, side, out_dir, margin_ps):
+    signals = {}
+    for (c, h, s), *sectors in diffs:
+        sector = sectors[side]
+        if sector is None or sector.capture == '-':
+            continue
+        if sector.capture not in signals:
+            signals[sector.capture] = read_vcd(
+                os.path.join(index.data_dir, sector.capture))
+        signal = signals[sector.capture]
+        start_ps = sector.start_ps - margin_ps
+        start_ps -= start_ps % signal.timescale_ps
+        fn = os.path.join(out_dir, '%s-c%02d-h%d-s%02d.vcd' % (label, c, h, s))
+        print('Writing', fn)
+        write_vcd(fn, crop(signal, start_ps, sector.end_ps + margin_ps))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report the sectors that differ between two images, '
+        'using the indexes that generate-image.py writes next to them.')
+    parser.add_argument('index_a', help='First image index (image.bin.idx)')
+    parser.add_argument('index_b', help='Second image index')
+    parser.add_argument('--extract', metavar='DIR',
+        help='Write the flux of each differing sector from both dumps to '
+        '.vcd files in DIR')
+    parser.add_argument('--margin-us', type=int, default=100,
+        help='Flux to extract either side of each sector, in us')
+    args = parser.parse_args()
+
+    a = read_index(args.index_a)
+    b = read_index(args.index_b)
+    if a.geometry != b.geometry:
+        print('Geometry differs: %s vs %s' % (a.geometry, b.geometry))
+    diffs = diff_indexes(a, b)
+    for (c, h, s), sa, sb in diffs:
+        print('c=%d h=%d s=%d: a: %s, b: %s' % (
+            c, h, s, describe(sa), describe(sb)))
+    print('%d sectors differ' % len(diffs))
+
+    if args.extract and diffs:
+        if not os.path.exists(args.extract):
+            os.makedirs(args.extract)
+        margin_ps = args.margin_us * 10 ** 6
+        extract_flux(a, 'a', diffs, 0, args.extract, margin_ps)
+        extract_flux(b, 'b', diffs, 1, args.extract, margin_ps)
+
+if __name__ == '__main__':
+    main()
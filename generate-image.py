@@ -20,10 +20,17 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import bisect
 import os
-import subprocess
 import sys
 
+from image_index import ImageIndex, Sector, data_hash, write_index
+from srd_runner import decode_sectors
+from vcd import falling_edges, read_vcd
+
+INDEX_CHANNEL = '1'
+FLUX_CHANNEL = '2'
+
 if len(sys.argv) > 1:
     data_dir = sys.argv[1]
 else:
@@ -32,46 +39,93 @@ if len(sys.argv) > 2:
     image_fn = sys.argv[2]
 else:
     image_fn = 'image.bin'
+index_fn = image_fn + '.idx'
 
 data_fns = os.listdir(data_dir)
 data_fns = [fn for fn in data_fns if fn.endswith('.vcd')]
 
+# Each entry is (capture filename, revolution, decoded sector)
 sectors = []
+# Capture filename -> length of one sample in ps
+timescales = {}
 #n = 0
 for data_fn in data_fns:
-    cmd = [
-        'sigrok-cli',
-        '-I', 'vcd',
-        '-i', os.path.join(data_dir, data_fn),
-        '-P', 'floppy_flux:flux=2:frequency=1000000,floppy_ibm_pc',
-        '-B', 'floppy_ibm_pc'
-    ]
-    print('+', ' '.join(cmd))
-    cp = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, encoding='UTF-8')
-    for l in cp.stdout.splitlines():
-        sectors.append(eval(l))
+    print('Decoding', data_fn)
+    signal = read_vcd(os.path.join(data_dir, data_fn))
+    timescales[data_fn] = signal.timescale_ps
+    index_edges = falling_edges(signal.channels[INDEX_CHANNEL][1])
+    for sector in decode_sectors(signal, FLUX_CHANNEL):
+        rev = bisect.bisect_right(index_edges, sector[6] * signal.timescale_ps)
+        sectors.append((data_fn, rev, sector))
     #n += 1
     #if n >= 4:
     #    break
 
-cylinders = max([sector[0] for sector in sectors]) + 1
-heads = max([sector[1] for sector in sectors]) + 1
-num_secs = max([sector[2] for sector in sectors]) # 1-based
-sec_sizes = {len(sector[3]) for sector in sectors}
+cylinders = max([sector[0] for _, _, sector in sectors]) + 1
+heads = max([sector[1] for _, _, sector in sectors]) + 1
+num_secs = max([sector[2] for _, _, sector in sectors]) # 1-based
+sec_sizes = {len(sector[3]) for _, _, sector in sectors}
 if len(sec_sizes) != 1:
     raise Exception("More than one sector size!")
 sec_size = sec_sizes.pop()
 print(cylinders, heads, num_secs, sec_size)
 
+# Each sector is read once per revolution, and may be found in more than one
+# capture. Use the first copy with a good CRC, or else the last copy.
+best = {}
+for data_fn, rev, sector in sectors:
+    c, h, s, data, found_crc, calc_crc = sector[:6]
+    if (c, h, s) in best:
+        prev_found_crc, prev_calc_crc = best[(c, h, s)][2][4:6]
+        if prev_found_crc == prev_calc_crc:
+            continue
+    best[(c, h, s)] = (data_fn, rev, sector)
+
 image = bytearray(cylinders * heads * num_secs * sec_size)
+index = ImageIndex(
+    os.path.relpath(data_dir, os.path.dirname(os.path.abspath(index_fn))),
+    (cylinders, heads, num_secs, sec_size))
 
-for c, h, s, data, found_crc, calc_crc in sectors:
+def offset_of(c, h, s):
     offset = c * heads
     offset += h
     offset *= num_secs
     offset += s - 1
     offset *= sec_size
+    return offset
+
+for (c, h, s), (data_fn, rev, sector) in best.items():
+    data, found_crc, calc_crc, ss, es = sector[3:8]
+    offset = offset_of(c, h, s)
     image[offset:offset+sec_size] = data
 
+for c in range(cylinders):
+    for h in range(heads):
+        statuses = ''
+        for s in range(1, num_secs + 1):
+            offset = offset_of(c, h, s)
+            sec_hash = data_hash(bytes(image[offset:offset+sec_size]))
+            if (c, h, s) not in best:
+                sector = Sector(sec_hash, 'missing', '-', -1, 0, 0)
+            else:
+                data_fn, rev, decoded = best[(c, h, s)]
+                data, found_crc, calc_crc, ss, es = decoded[3:8]
+                timescale_ps = timescales[data_fn]
+                sector = Sector(
+                    sec_hash,
+                    'ok' if found_crc == calc_crc else 'bad',
+                    data_fn,
+                    rev,
+                    ss * timescale_ps,
+                    es * timescale_ps)
+            index.sectors[(c, h, s)] = sector
+            statuses += sector.status[0]
+        # Cover the CRC statuses too, so that e.g. a missing sector doesn't
+        # match one that was read correctly and happens to hold zeros.
+        offset = offset_of(c, h, 1)
+        index.tracks[(c, h)] = data_hash(
+            bytes(image[offset:offset+num_secs*sec_size]) + statuses.encode())
+
 with open(image_fn, 'wb') as f:
     f.write(image)
+write_index(index_fn, index)
@@ -0,0 +1,114 @@
+
+# Copyright 2019 Stephen Warren <swarren@wwwdotorg.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+# Sidecar index that generate-image.py writes next to each image, recording a
+# hash of every track and sector, whether each sector's CRC was good, and which
+# capture file (and which revolution within it) each sector came from. Two
+# indexes can be compared far faster than two images and their captures.
+#
+# The file is text, one record per line:
+#
+# floppy-image-index 1
+# data_dir <directory holding the captures, relative to the index file>
+# geometry <cylinders> <heads> <sectors per track> <sector size>
+# track <c> <h> <hash>
+# sector <c> <h> <s> <hash> <status> <capture> <revolution> <start ps> <end ps>
+#
+# A track's hash covers its sectors' data and statuses. A sector's status is
+# ok, bad (CRC error) or missing (not found in any capture). For a
+# missing sector, the capture is "-". Revolution 0 is the partial revolution
+# before the first INDEX pulse in the capture.
+
+import collections
+import hashlib
+import os
+
+VERSION = 1
+
+Sector = collections.namedtuple('Sector',
+    'hash status capture revolution start_ps end_ps')
+
+def data_hash(data):
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+class ImageIndex(object):
+    def __init__(self, data_dir, geometry):
+        # As written to the file by write_index(). After read_index(), the
+        # directory where the captures were actually found.
+        self.data_dir = data_dir
+        # (cylinders, heads, sectors per track, sector size)
+        self.geometry = geometry
+        # (c, h) -> hash
+        self.tracks = {}
+        # (c, h, s) -> Sector
+        self.sectors = {}
+
+def write_index(filename, index):
+    with open(filename, 'w') as f:
+        f.write('floppy-image-index %d\n' % VERSION)
+        f.write('data_dir %s\n' % index.data_dir)
+        f.write('geometry %d %d %d %d\n' % index.geometry)
+        for (c, h), track_hash in sorted(index.tracks.items()):
+            f.write('track %d %d %s\n' % (c, h, track_hash))
+        for (c, h, s), sector in sorted(index.sectors.items()):
+            f.write('sector %d %d %d %s %s %s %d %d %d\n' % (
+                (c, h, s) + tuple(sector)))
+
+def read_index(filename):
+    with open(filename, 'r') as f:
+        lines = f.read().splitlines()
+    if lines[0] != 'floppy-image-index %d' % VERSION:
+        raise Exception('Not a version %d image index: %s' % (
+            VERSION, filename))
+    index = ImageIndex(None, None)
+    for l in lines[1:]:
+        key, _, rest = l.partition(' ')
+        if key == 'data_dir':
+            index.data_dir = rest
+        elif key == 'geometry':
+            index.geometry = tuple(int(v) for v in rest.split())
+        elif key == 'track':
+            c, h, track_hash = rest.split()
+            index.tracks[(int(c), int(h))] = track_hash
+        elif key == 'sector':
+            c, h, s, sec_hash, status, capture, rev, start, end = rest.split()
+            index.sectors[(int(c), int(h), int(s))] = Sector(
+                sec_hash, status, capture, int(rev), int(start), int(end))
+        else:
+            raise Exception('Bad line in %s: %s' % (filename, l))
+    index.data_dir = find_data_dir(filename, index.data_dir)
+    return index
+
+def find_data_dir(index_fn, data_dir):
+    # The dump may have been moved or copied since the index was written (and
+    # older indexes hold an absolute path), so fall back to looking next to the
+    # index file.
+    index_dir = os.path.dirname(os.path.abspath(index_fn))
+    candidates = [
+        os.path.join(index_dir, data_dir),
+        os.path.join(index_dir, os.path.basename(data_dir.rstrip(os.sep))),
+        index_dir,
+    ]
+    for candidate in candidates:
+        if os.path.isdir(candidate):
+            return candidate
+    return candidates[0]
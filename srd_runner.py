@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Stephen Warren <swarren@wwwdotorg.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+# Runs the sigrok protocol decoders in decoders/ in this process, without
+# sigrok-cli or libsigrokdecode. Only the parts of the sigrokdecode API that
+# those decoders use are implemented: Decoder.wait(), put(), register() and
+# metadata(). Samples are fed from a vcd.Signal, and each decoder's Python
+# output is passed straight to the decode() method of the decoder stacked on
+# top of it.
+#
+# Run this file directly to decode a capture and print the sectors found, in
+# the same format as sigrok-cli -B floppy_ibm_pc.
+
+import collections
+import importlib
+import os
+import sys
+import types
+
+from vcd import PS_PER_S, read_vcd
+
+OUTPUT_ANN = 0
+OUTPUT_PYTHON = 1
+OUTPUT_BINARY = 2
+OUTPUT_META = 3
+
+SRD_CONF_SAMPLERATE = 10000
+
+DECODERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'decoders')
+
+class EndOfData(Exception):
+    pass
+
+class Decoder(object):
+    # Stands in for sigrokdecode.Decoder. Decoders don't call this class's
+    # __init__, so run_stack() sets up the attributes used here.
+
+    def register(self, output_type, proto_id=None, meta=None):
+        self._outputs.append(output_type)
+        return len(self._outputs) - 1
+
+    def put(self, ss, es, output_id, data):
+        output_type = self._outputs[output_id]
+        if self._next:
+            if output_type == OUTPUT_PYTHON:
+                self._next.decode(ss, es, data)
+        elif output_type in self._collect:
+            self._results.append((output_type, ss, es, data))
+
+    def wait(self, conds=None):
+        return self._samples.wait(self, conds)
+
+sigrokdecode = types.ModuleType('sigrokdecode')
+sigrokdecode.Decoder = Decoder
+sigrokdecode.OUTPUT_ANN = OUTPUT_ANN
+sigrokdecode.OUTPUT_PYTHON = OUTPUT_PYTHON
+sigrokdecode.OUTPUT_BINARY = OUTPUT_BINARY
+sigrokdecode.OUTPUT_META = OUTPUT_META
+sigrokdecode.SRD_CONF_SAMPLERATE = SRD_CONF_SAMPLERATE
+
+def load_decoder(decoder_id):
+    sys.modules['sigrokdecode'] = sigrokdecode
+    if DECODERS_DIR not in sys.path:
+        sys.path.insert(0, DECODERS_DIR)
+    return importlib.import_module(decoder_id).Decoder
+
+class Samples(object):
+    # The sample stream of the bottom decoder in a stack. Only the samples at
+    # which a channel changes are visited, rather than every sample.
+
+    def __init__(self, signal, names):
+        ts = signal.timescale_ps
+        self.levels = [signal.channels[name][0] for name in names]
+        events = []
+        for i, name in enumerate(names):
+            for t, val in signal.channels[name][1]:
+                events.append((t // ts, i, val))
+        events.sort()
+        self.events = events
+        self.pos = 0
+        while self.pos < len(events) and events[self.pos][0] == 0:
+            _, i, val = events[self.pos]
+            self.levels[i] = val
+            self.pos += 1
+        self.num_samples = signal.duration_ps // ts
+        self.cur = 0
+
+    def _match(self, cond, edges, offset):
+        for key, val in cond.items():
+            if key == 'skip':
+                if offset != val:
+                    return False
+            elif val == 'l':
+                if self.levels[key] != 0:
+                    return False
+            elif val == 'h':
+                if self.levels[key] != 1:
+                    return False
+            elif val == 'r':
+                if edges.get(key) != 1:
+                    return False
+            elif val == 'f':
+                if edges.get(key) != 0:
+                    return False
+            elif val == 'e':
+                if key not in edges:
+                    return False
+            elif val == 'n':
+                if key in edges:
+                    return False
+            else:
+                raise Exception('Unsupported condition: %s' % repr(cond))
+        return True
+
+    def wait(self, d, conds):
+        if conds is None:
+            conds = [{}]
+        elif isinstance(conds, dict):
+            conds = [conds]
+        events = self.events
+        start = self.cur
+        s = start + 1
+        while s < self.num_samples:
+            edges = {}
+            while self.pos < len(events) and events[self.pos][0] <= s:
+                _, i, val = events[self.pos]
+                if val != self.levels[i]:
+                    edges[i] = val
+                    self.levels[i] = val
+                self.pos += 1
+            matched = tuple(self._match(cond, edges, s - start)
+                for cond in conds)
+            if any(matched):
+                self.cur = s
+                d.samplenum = s
+                d.matched = matched
+                return tuple(self.levels)
+            # Nothing can match again until a channel changes, or a skip
+            # count is reached.
+            if self.pos < len(events):
+                nxt = events[self.pos][0]
+            else:
+                nxt = self.num_samples
+            for cond in conds:
+                target = start + cond.get('skip', 0)
+                if s < target < nxt:
+                    nxt = target
+            s = nxt
+        raise EndOfData()
+
+def run_stack(signal, stack, collect=(OUTPUT_PYTHON, )):
+    # stack is a list of (decoder id, options, channels), bottom decoder
+    # first. channels maps the bottom decoder's channel ids to the names of
+    # channels in the signal. Returns the top decoder's output of the types in
+    # collect, as a list of (output type, ss, es, data).
+    decoders = []
+    for decoder_id, options, channels in stack:
+        cls = load_decoder(decoder_id)
+        d = cls()
+        d.options = {o['id']: o['default'] for o in getattr(cls, 'options', ())}
+        d.options.update(options)
+        d.samplenum = 0
+        d.matched = None
+        d._outputs = []
+        d._next = None
+        decoders.append(d)
+    for lower, upper in zip(decoders, decoders[1:]):
+        lower._next = upper
+    results = []
+    decoders[-1]._results = results
+    decoders[-1]._collect = collect
+
+    samplerate = PS_PER_S // signal.timescale_ps
+    for d in decoders:
+        if hasattr(d, 'metadata'):
+            d.metadata(SRD_CONF_SAMPLERATE, samplerate)
+        d.start()
+
+    bottom = decoders[0]
+    channels = stack[0][2]
+    all_channels = tuple(getattr(bottom, 'channels', ())) + \
+        tuple(getattr(bottom, 'optional_channels', ()))
+    bottom._samples = Samples(signal, [channels[ch['id']] for ch in all_channels])
+    try:
+        bottom.decode()
+    except EndOfData:
+        pass
+    return results
+
+# floppy_ibm_pc's Python output, plus the samples at which the sector's ID
+# address mark starts and its data CRC ends, and whether the ID field's CRC
+# was good (found_crc and calc_crc are the data field's).
+DecodedSector = collections.namedtuple('DecodedSector',
+    'cylinder head sector data found_crc calc_crc ss es id_crc_ok')
+
+def decode_sectors(signal, flux_channel='2', frequency=1000000):
+    # Equivalent of:
+    # sigrok-cli -P floppy_flux:flux=2:frequency=1000000,floppy_ibm_pc \
+    #     -B floppy_ibm_pc
+    # The decoder's Python output doesn't say where each sector is, or whether
+    # its ID field was intact, so that's taken from the annotations that
+    # accompany it.
+    results = run_stack(signal, [
+        ('floppy_flux', {'frequency': frequency}, {'flux': flux_channel}),
+        ('floppy_ibm_pc', {}, None),
+    ], (OUTPUT_ANN, OUTPUT_PYTHON))
+    sectors = []
+    id_ss = None
+    id_crc_ok = False
+    in_id_crc = False
+    for output_type, ss, es, data in results:
+        if output_type == OUTPUT_PYTHON:
+            sectors.append(DecodedSector(*data, id_ss, es, id_crc_ok))
+        elif data == [2, ['ID address mark']]:
+            id_ss = ss
+            id_crc_ok = False
+        elif data == [2, ['ID CRC']]:
+            in_id_crc = True
+        elif in_id_crc and data[0] == 3:
+            id_crc_ok = data[1] == ['OK']
+            in_id_crc = False
+    return sectors
+
+if __name__ == '__main__':
+    for sector in decode_sectors(read_vcd(sys.argv[1])):
+        print(repr(tuple(sector[:6])))
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+# Copyright 2019 Stephen Warren <swarren@wwwdotorg.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import argparse
+import os
+import random
+import tempfile
+
+from srd_runner import decode_sectors
+from vcd import PS_PER_S, Signal, read_vcd, write_vcd
+
+INDEX_CHANNEL = '1'
+FLUX_CHANNEL = '2'
+
+def parse_rate(s):
+    mult = 1
+    if s[-1] in 'kK':
+        mult = 1000
+        s = s[:-1]
+    elif s[-1] in 'mM':
+        mult = 1000000
+        s = s[:-1]
+    return int(float(s) * mult)
+
+def format_rate(rate):
+    if rate % 1000000 == 0:
+        return '%dm' % (rate // 1000000)
+    if rate % 1000 == 0:
+        return '%dk' % (rate // 1000)
+    return str(rate)
+
+def resample(changes, rate, num_samples):
+    # Sample n (taken at time n / rate) sees the most recent change at or
+    # before that instant. Several changes that fall between two sample
+    # instants therefore collapse to just the last one; a pulse narrower than
+    # the sample period may vanish entirely, just as it would on real
+    # hardware.
+    out = []
+    pending = None
+    for t, val in changes:
+        n = -(-t * rate // PS_PER_S)
+        if n >= num_samples:
+            break
+        if pending is not None and pending[0] != n:
+            out.append(pending)
+        pending = (n, val)
+    if pending is not None:
+        out.append(pending)
+    return out
+
+def resample_signal(signal, rate, window_ps):
+    if PS_PER_S % rate:
+        raise Exception('Sample rate %d has no whole ps period' % rate)
+    period_ps = PS_PER_S // rate
+    num_samples = min(window_ps, signal.duration_ps) * rate // PS_PER_S
+    channels = {}
+    for name, (val, changes) in signal.channels.items():
+        channels[name] = (val, [(n * period_ps, new_val)
+            for n, new_val in resample(changes, rate, num_samples)])
+    return Signal(channels, num_samples * period_ps, period_ps)
+
+def calc_crc16(data):
+    poly = 0x1021
+    crc = 0xffff
+    for d in data:
+        d <<= 9
+        for _ in range(8):
+            crc <<= 1
+            if (crc ^ d) & 0x10000:
+                crc ^= poly
+            d <<= 1
+    return crc & 0xffff
+
+class MfmEncoder(object):
+    def __init__(self):
+        self.cells = []
+        self.prev_data = 0
+
+    def byte(self, val, count=1):
+        for _ in range(count):
+            for bit in range(7, -1, -1):
+                data = (val >> bit) & 1
+                clk = 1 if ((self.prev_data == 0) and (data == 0)) else 0
+                self.cells.append(clk)
+                self.cells.append(data)
+                self.prev_data = data
+
+    def bytes(self, vals):
+        for val in vals:
+            self.byte(val)
+
+    def sync(self):
+        # 0xA1 with a missing clock bit
+        for _ in range(3):
+            for bit in range(15, -1, -1):
+                self.cells.append((0x4489 >> bit) & 1)
+        self.prev_data = 1
+
+def synth_track(rng, track, num_secs, cell_rate, rev_ms):
+    track_bytes = rev_ms * cell_rate // (16 * 1000)
+    enc = MfmEncoder()
+    ref = {}
+    enc.byte(0x4e, 50)
+    for s in range(1, num_secs + 1):
+        data = bytes(rng.getrandbits(8) for _ in range(512))
+        ref[(track, 0, s)] = data
+        idam = [0xfe, track, 0, s, 2]
+        enc.byte(0x00, 12)
+        enc.sync()
+        enc.bytes(idam)
+        crc = calc_crc16([0xa1, 0xa1, 0xa1] + idam)
+        enc.bytes([crc >> 8, crc & 0xff])
+        enc.byte(0x4e, 22)
+        enc.byte(0x00, 12)
+        enc.sync()
+        enc.byte(0xfb)
+        enc.bytes(data)
+        crc = calc_crc16([0xa1, 0xa1, 0xa1, 0xfb] + list(data))
+        enc.bytes([crc >> 8, crc & 0xff])
+        enc.byte(0x4e, 84)
+    fill = track_bytes - (len(enc.cells) // 16)
+    if fill < 0:
+        raise Exception('%d sectors do not fit on a track' % num_secs)
+    enc.byte(0x4e, fill)
+    return enc.cells, ref
+
+def synth_signal(cells, cell_rate, rev_ms, duration_ps, pulse_ps, jitter_ps,
+        rng):
+    # Drives emit a short negative pulse on RDATA per flux transition, and a
+    # longer negative pulse on INDEX once per revolution. Captures start at an
+    # arbitrary point in the rotation.
+    cell_ps = PS_PER_S // cell_rate
+    rev_ps = rev_ms * 10 ** 9
+    offset_ps = rng.randrange(rev_ps)
+    index = []
+    t = rev_ps - offset_ps
+    while t < duration_ps:
+        index.append((t, 0))
+        index.append((t + 2 * 10 ** 9, 1))
+        t += rev_ps
+    flux = []
+    t = -offset_ps
+    while t < duration_ps:
+        for i, cell in enumerate(cells):
+            if not cell:
+                continue
+            edge = t + i * cell_ps + cell_ps // 2
+            edge += int(rng.gauss(0, jitter_ps))
+            if edge < 0 or edge >= duration_ps:
+                continue
+            flux.append((edge, 0))
+            flux.append((edge + pulse_ps, 1))
+        t += rev_ps
+    return Signal({
+        INDEX_CHANNEL: (1, index),
+        FLUX_CHANNEL: (1, flux),
+    }, duration_ps)
+
+def good_sectors(sectors):
+    return {(c, h, s): data
+        for c, h, s, data, found_crc, calc_crc, ss, es, id_crc_ok in sectors
+        if found_crc == calc_crc}
+
+def count_recovered(sectors, ref):
+    good = good_sectors(sectors)
+    return len([chs for chs, data in ref.items() if good.get(chs) == data])
+
+def list_captures(paths):
+    fns = []
+    for path in paths:
+        if os.path.isdir(path):
+            fns += sorted(os.path.join(path, fn) for fn in os.listdir(path)
+                if fn.endswith('.vcd'))
+        else:
+            fns.append(path)
+    return fns
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate cheaper capture settings by decimating and '
+        'truncating captures, and report how many sectors still decode.')
+    parser.add_argument('captures', nargs='*',
+        help='.vcd captures, or directories containing them')
+    parser.add_argument('--rates', default='25m,10m,5m,1m',
+        help='Comma-separated sample rates to simulate')
+    parser.add_argument('--windows', default='425,325,250,225',
+        help='Comma-separated capture windows to simulate, in ms')
+    parser.add_argument('--frequency', type=int, default=1000000,
+        help='MFM bit cell frequency; 1000000 for HD, 500000 for DD')
+    parser.add_argument('--synthetic', type=int, default=0,
+        help='Number of synthetic tracks to generate and sweep')
+    parser.add_argument('--sectors', type=int, default=18,
+        help='Sectors per synthetic track')
+    parser.add_argument('--rev-ms', type=int, default=200,
+        help='Duration of one synthetic revolution, in ms')
+    parser.add_argument('--pulse-ns', type=int, default=400,
+        help='Width of synthetic RDATA pulses, in ns')
+    parser.add_argument('--jitter-ns', type=int, default=40,
+        help='Standard deviation of synthetic flux transition jitter, in ns')
+    parser.add_argument('--seed', type=int, default=0,
+        help='Random seed for synthetic tracks')
+    args = parser.parse_args()
+
+    rates = [parse_rate(r) for r in args.rates.split(',')]
+    windows = [int(w) for w in args.windows.split(',')]
+    if not args.captures and not args.synthetic:
+        parser.error('No captures and no synthetic tracks to sweep')
+
+    # Each source is (name, Signal loader, reference sectors). Reference
+    # sectors come from decoding the untouched capture, or are known up-front
+    # for synthetic tracks.
+    sources = []
+    for fn in list_captures(args.captures):
+        sources.append((fn, lambda fn=fn: read_vcd(fn), None))
+    rng = random.Random(args.seed)
+    for track in range(args.synthetic):
+        cells, ref = synth_track(
+            rng, track, args.sectors, args.frequency, args.rev_ms)
+        duration_ps = max(windows) * 10 ** 9
+        signal = synth_signal(cells, args.frequency, args.rev_ms, duration_ps,
+            args.pulse_ns * 1000, args.jitter_ns * 1000, rng)
+        sources.append(
+            ('synthetic-t%02d' % track, lambda signal=signal: signal, ref))
+
+    # (rate, window) -> [recovered, expected, vcd bytes, raw bytes]
+    totals = {(rate, window): [0, 0, 0, 0]
+        for rate in rates for window in windows}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, load, ref in sources:
+            signal = load()
+            if ref is None:
+                ref = good_sectors(decode_sectors(
+                    signal, FLUX_CHANNEL, args.frequency))
+            for rate in rates:
+                for window in windows:
+                    vcd_fn = os.path.join(tmp_dir, 'sweep.vcd')
+                    window_ps = window * 10 ** 9
+                    resampled = resample_signal(signal, rate, window_ps)
+                    write_vcd(vcd_fn, resampled)
+                    recovered = count_recovered(decode_sectors(
+                        resampled, FLUX_CHANNEL, args.frequency), ref)
+                    vcd_bytes = os.path.getsize(vcd_fn)
+                    num_samples = \
+                        min(window_ps, signal.duration_ps) * rate // PS_PER_S
+                    # sigrok stores samples in whole bytes, not packed bits
+                    raw_bytes = num_samples * -(-len(signal.channels) // 8)
+                    print('%s rate %s window %dms: %d/%d sectors, %d bytes' % (
+                        name, format_rate(rate), window, recovered, len(ref),
+                        vcd_bytes))
+                    total = totals[(rate, window)]
+                    total[0] += recovered
+                    total[1] += len(ref)
+                    total[2] += vcd_bytes
+                    total[3] += raw_bytes
+
+    print()
+    print('%8s %8s %10s %8s %12s %12s' % (
+        'rate', 'window', 'sectors', 'percent', 'vcd bytes', 'raw bytes'))
+    cheapest = None
+    for (rate, window), (recovered, expected, vcd_bytes, raw_bytes) in \
+            sorted(totals.items(), key=lambda kv: kv[1][2]):
+        percent = 100.0 * recovered / expected if expected else 0.0
+        print('%8s %6dms %4d/%-5d %7.2f%% %12d %12d' % (
+            format_rate(rate), window, recovered, expected, percent,
+            vcd_bytes, raw_bytes))
+        if cheapest is None and expected and recovered == expected:
+            cheapest = (rate, window)
+    print()
+    if cheapest:
+        print('Cheapest setting with full recovery: samplerate=%s, %dms' % (
+            format_rate(cheapest[0]), cheapest[1]))
+    else:
+        print('No setting recovered every sector')
+
+if __name__ == '__main__':
+    main()
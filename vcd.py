@@ -0,0 +1,141 @@
+
+# Copyright 2019 Stephen Warren <swarren@wwwdotorg.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+# Minimal reader/writer for the .vcd files that sigrok-cli writes.
+
+PS_PER_S = 10 ** 12
+
+TIMESCALE_UNITS = {
+    's': 10 ** 12,
+    'ms': 10 ** 9,
+    'us': 10 ** 6,
+    'ns': 10 ** 3,
+    'ps': 1,
+}
+
+class Signal(object):
+    # Channel name -> (initial value, [(time in ps, value), ...]), plus the
+    # total length of the signal in ps, and the length of one sample in ps (if
+    # the signal was sampled).
+    def __init__(self, channels, duration_ps, timescale_ps=None):
+        self.channels = channels
+        self.duration_ps = duration_ps
+        self.timescale_ps = timescale_ps
+
+def read_vcd(filename, end_ps=None):
+    # If end_ps is given, only the signal before that time is read.
+    with open(filename, 'r') as f:
+        header, body = f.read().split('$enddefinitions', 1)
+    tokens = header.replace('$end', ' $end ').split()
+    timescale_ps = None
+    id_to_name = {}
+    i = 0
+    while i < len(tokens):
+        if tokens[i] == '$timescale':
+            ts = ''.join(tokens[i + 1:tokens.index('$end', i)])
+            num = ts.rstrip('munps')
+            timescale_ps = int(num) * TIMESCALE_UNITS[ts[len(num):]]
+        elif tokens[i] == '$var':
+            # $var wire 1 <id> <name> $end
+            id_to_name[tokens[i + 3]] = tokens[i + 4]
+        i += 1
+    if timescale_ps is None:
+        raise Exception('No $timescale in ' + filename)
+
+    channels = {name: [None, []] for name in id_to_name.values()}
+    t = 0
+    for tok in body.split():
+        if tok[0] == '#':
+            t = int(tok[1:]) * timescale_ps
+            if end_ps is not None and t >= end_ps:
+                t = end_ps
+                break
+            continue
+        if tok[0] not in '01':
+            # $end, $dumpvars, x/z values, ...
+            continue
+        name = id_to_name[tok[1:]]
+        val = int(tok[0])
+        channel = channels[name]
+        if channel[0] is None:
+            channel[0] = val
+        else:
+            channel[1].append((t, val))
+    for channel in channels.values():
+        if channel[0] is None:
+            channel[0] = 1
+    return Signal(
+        {name: tuple(channel) for name, channel in channels.items()}, t,
+        timescale_ps)
+
+def write_vcd(filename, signal):
+    timescale_ps = signal.timescale_ps
+    if timescale_ps % 1000:
+        timescale = '%d ps' % timescale_ps
+    else:
+        timescale = '%d ns' % (timescale_ps // 1000)
+
+    names = sorted(signal.channels.keys())
+    ids = {name: chr(ord('!') + i) for i, name in enumerate(names)}
+    events = {}
+    initial = []
+    for name in names:
+        val, changes = signal.channels[name]
+        initial.append('%d%s' % (val, ids[name]))
+        for t, new_val in changes:
+            if new_val == val:
+                continue
+            val = new_val
+            events.setdefault(t // timescale_ps, []).append(
+                '%d%s' % (val, ids[name]))
+
+    with open(filename, 'w') as f:
+        f.write('$timescale %s $end\n' % timescale)
+        f.write('$scope module libsigrok $end\n')
+        for name in names:
+            f.write('$var wire 1 %s %s $end\n' % (ids[name], name))
+        f.write('$upscope $end\n')
+        f.write('$enddefinitions $end\n')
+        f.write('#0 %s\n' % ' '.join(initial))
+        for n in sorted(events.keys()):
+            if n == 0:
+                continue
+            f.write('#%d %s\n' % (n, ' '.join(events[n])))
+        f.write('#%d\n' % (signal.duration_ps // timescale_ps))
+
+def crop(signal, start_ps, end_ps):
+    # The part of the signal from start_ps to end_ps, with its times shifted to
+    # start at 0.
+    start_ps = max(0, start_ps)
+    end_ps = min(signal.duration_ps, end_ps)
+    channels = {}
+    for name, (val, changes) in signal.channels.items():
+        cropped = []
+        for t, new_val in changes:
+            if t <= start_ps:
+                val = new_val
+            elif t < end_ps:
+                cropped.append((t - start_ps, new_val))
+        channels[name] = (val, cropped)
+    return Signal(channels, end_ps - start_ps, signal.timescale_ps)
+
+def falling_edges(changes):
+    return [t for t, val in changes if val == 0]